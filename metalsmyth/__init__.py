@@ -4,9 +4,29 @@ which reads files from a source directory, registers middleware
 and processes files.
 """
 import glob
+import io
 import os
+import re
+import tempfile
+import zlib
 
 import frontmatter
+import yaml
+
+MANIFEST_PATTERN = '.metalsmyth-{0}-of-{1}.yaml'
+
+# same YAML delimiter python-frontmatter uses
+YAML_DELIMITER = re.compile(r'^-{3,}\s*$')
+
+
+class ManifestDumper(yaml.SafeDumper):
+    """
+    Safe YAML dumper for manifests, which also writes string subclasses
+    (like markupsafe.Markup) as plain strings
+    """
+
+ManifestDumper.add_multi_representer(type(u''),
+    lambda dumper, data: dumper.represent_data(type(u'')(data)))
 
 
 class PostNotFound(Exception):
@@ -18,25 +38,139 @@ class PostNotFound(Exception):
 class Stack(object):
     """
     A Stack takes a source directory, output directory, optional middleware and metadata
+
+    Pass shard=(index, count) to load, process and build only part of the
+    source directory, so several workers can split up a big build.
+
+    Pass filters=[...] to skip files at load time, based only on metadata.
     """
     def __init__(self, source='src', *middleware, **metadata):
         self.source = source
         self.dest = metadata.pop('dest', None)
+        self.shard = metadata.pop('shard', None)
+        self.filters = list(metadata.pop('filters', []))
         self.middleware = list(middleware)
         self.metadata = dict(metadata)
         self.files = {}
 
+        # True while middleware runs on a single file, from Stack.get
+        self.partial = False
+
+        if self.shard is not None:
+            index, count = self.shard
+            if count < 1 or not 0 <= index < count:
+                raise ValueError('shard must be (index, count) with 0 <= index < count')
+
+    def in_shard(self, filename):
+        """
+        Return True if filename belongs to this stack's shard.
+        Files are assigned by a stable hash of their path relative to source,
+        so every worker agrees on who owns what.
+        """
+        if self.shard is None:
+            return True
+
+        index, count = self.shard
+        checksum = zlib.crc32(filename.encode('utf-8')) & 0xffffffff
+        return checksum % count == index
+
+    def get_filters(self):
+        """
+        Return all load-time filters: those registered on the stack,
+        plus the `predicate` attribute of any middleware that has one.
+        """
+        filters = list(self.filters)
+        for func in self.middleware:
+            predicate = getattr(func, 'predicate', None)
+            if callable(predicate):
+                filters.append(predicate)
+
+        return filters
+
+    def read_header(self, f):
+        """
+        Read just the YAML frontmatter block from an open file, leaving
+        the body unread. Returns (metadata, lines), or (None, lines) if
+        the file doesn't start with a YAML block that parses to a dict.
+        """
+        lines = [f.readline()]
+        if not YAML_DELIMITER.match(lines[0]):
+            return None, lines
+
+        while True:
+            line = f.readline()
+            if not line:
+                # no closing delimiter, so this isn't frontmatter we understand
+                return None, lines
+
+            lines.append(line)
+            if YAML_DELIMITER.match(line):
+                break
+
+        try:
+            metadata = yaml.safe_load(''.join(lines[1:-1]))
+        except yaml.YAMLError:
+            return None, lines
+
+        if metadata is None:
+            metadata = {}
+
+        if not isinstance(metadata, dict):
+            return None, lines
+
+        return metadata, lines
+
+    def load(self, filename, filters=None):
+        """
+        Load and parse a single file, returning None if any filter rejects it.
+        Pass filters to skip looking them up again for each file.
+
+        For files with YAML frontmatter, filters only see metadata, so rejected
+        files never have their body loaded. Other files, such as those with
+        TOML or JSON frontmatter, are fully loaded before filters run.
+        """
+        path = os.path.join(self.source, filename)
+        slug = os.path.splitext(filename)[0]
+        if filters is None:
+            filters = self.get_filters()
+
+        if not filters:
+            return frontmatter.load(path, filename=filename, slug=slug)
+
+        # read the header first, and the rest only if filters pass
+        with io.open(path, 'r', encoding='utf-8') as f:
+            metadata, lines = self.read_header(f)
+
+            if metadata is not None:
+                metadata.update(filename=filename, slug=slug)
+                if not all(func(filename, metadata) for func in filters):
+                    return None
+
+            text = ''.join(lines) + f.read()
+
+        post = frontmatter.loads(text, filename=filename, slug=slug)
+
+        # fall back to checking fully loaded posts in other formats
+        if metadata is None:
+            if not all(func(filename, post.metadata) for func in filters):
+                return None
+
+        return post
+
     def get_files(self):
         """
         Read and parse files from a directory,
         return a dictionary of path => post
         """
         files = {}
+        filters = self.get_filters()
         for filename in os.listdir(self.source):
-            path = os.path.join(self.source, filename)
-            files[filename] = frontmatter.load(path, 
-                filename=filename, 
-                slug=os.path.splitext(filename)[0])
+            if not self.in_shard(filename):
+                continue
+
+            post = self.load(filename, filters)
+            if post is not None:
+                files[filename] = post
 
         return files
 
@@ -59,7 +193,7 @@ class Stack(object):
         """
         Yield processed files one at a time, in natural order.
         """
-        files = os.listdir(self.source)
+        files = [fn for fn in os.listdir(self.source) if self.in_shard(fn)]
         files.sort(reverse=reverse)
 
         for filename in files:
@@ -73,19 +207,26 @@ class Stack(object):
         Get a single processed file. Uses a cached version
         if `run` has already been called, unless `reset` is True.
         """
+        # files in other shards belong to other workers
+        if not self.in_shard(filename):
+            raise PostNotFound('{0} not in shard {1}'.format(filename, self.shard))
+
         if filename in self.files and not reset:
             return self.files[filename]
 
         # load a single file, and process
         files = {}
-        path = os.path.join(self.source, filename)
-        files[filename] = frontmatter.load(path, 
-            filename=filename,
-            slug=os.path.splitext(filename)[0])
+        post = self.load(filename)
+        if post is not None:
+            files[filename] = post
 
-        # call middleware
-        for func in self.middleware:
-            func(files, self)
+        # call middleware, flagging that files isn't the whole site
+        self.partial = True
+        try:
+            for func in self.middleware:
+                func(files, self)
+        finally:
+            self.partial = False
 
         # cache the processed post
         self.files.update(files)
@@ -96,8 +237,13 @@ class Stack(object):
         except KeyError:
             raise PostNotFound('{0} not found'.format(filename))
 
-    def build(self, dest=None):
-        "Build out results to dest directory (creating if needed)"
+    def build(self, dest=None, clean=False):
+        """
+        Build out results to dest directory (creating if needed)
+
+        Sharded builds remove manifests left by builds with a different
+        shard count. Pass clean=True to remove every manifest in dest.
+        """
         # dest can be set here or on init
         if not dest:
             dest = self.dest
@@ -110,8 +256,12 @@ class Stack(object):
         self.dest = dest
 
         # ensure a build dir
-        if not os.path.isdir(self.dest):
+        # another shard may create it first, so only fail if it's still missing
+        try:
             os.makedirs(self.dest)
+        except OSError:
+            if not os.path.isdir(self.dest):
+                raise
 
         # make sure we have files
         if not self.files:
@@ -125,6 +275,116 @@ class Stack(object):
             with open(path, 'wb') as f:
                 f.write(post.content.encode('utf-8'))
 
+        # clear out stale manifests
+        for index, count, path in self.find_manifests():
+            if clean or (self.shard is not None and count != self.shard[1]):
+                # another shard may remove it first
+                try:
+                    os.remove(path)
+                except OSError:
+                    if os.path.exists(path):
+                        raise
+
+        # sharded builds leave a partial manifest for Stack.merge
+        if self.shard is not None:
+            self.write_manifest()
+
+    def find_manifests(self, dest=None):
+        """
+        Return (index, count, path) for each partial manifest in dest.
+        """
+        dest = dest or self.dest
+        manifests = []
+        for path in glob.glob(os.path.join(dest, MANIFEST_PATTERN.format('*', '*'))):
+            name = os.path.basename(path)[len('.metalsmyth-'):-len('.yaml')]
+            try:
+                index, count = [int(n) for n in name.split('-of-')]
+            except ValueError:
+                continue
+
+            manifests.append((index, count, path))
+
+        return manifests
+
+    def write_manifest(self):
+        """
+        Write metadata for this shard's files to a partial manifest in dest.
+        Content is left out, since it's already been written.
+        """
+        index, count = self.shard
+        path = os.path.join(self.dest, MANIFEST_PATTERN.format(index, count))
+        manifest = dict((fn, dict(p.metadata)) for fn, p in self.files.items())
+
+        # write to a temp file and rename, so merge never reads half a manifest
+        fd, tmp = tempfile.mkstemp(prefix='.metalsmyth-', suffix='.tmp', dir=self.dest)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yaml.dump(manifest, f, Dumper=ManifestDumper, default_flow_style=False)
+
+            # mkstemp makes files only we can read, but merge may run as someone else
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+
+        except yaml.representer.RepresenterError:
+            os.remove(tmp)
+            for filename, metadata in manifest.items():
+                for key, value in metadata.items():
+                    try:
+                        yaml.dump(value, Dumper=ManifestDumper)
+                    except yaml.representer.RepresenterError:
+                        raise ValueError('{0}: metadata field {1!r} ({2}) cannot be written to a manifest'
+                            .format(filename, key, type(value).__name__))
+            raise
+
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def merge(self, plugins=None, dest=None, count=None):
+        """
+        Combine partial manifests written by sharded builds in dest,
+        and run collection-level plugins over the combined metadata.
+        Plugins that make their own pages, like indexes or feeds,
+        should write them to `stack.dest` themselves.
+
+        Pass count to read only manifests from builds with that many shards.
+
+        Returns a dictionary of path => post, where each post has metadata
+        but no content. Raises ValueError if any shard's manifest is missing.
+        """
+        dest = dest or self.dest
+        if dest is None:
+            raise ValueError('destination directory must not be None')
+
+        # store build dir, so plugins know where to write
+        self.dest = dest
+
+        manifests = self.find_manifests(dest)
+        if count is not None:
+            manifests = [m for m in manifests if m[1] == count]
+
+        counts = set(m[1] for m in manifests)
+        if len(counts) > 1:
+            raise ValueError('manifests in {0} come from different shard counts'.format(dest))
+
+        shards = set(m[0] for m in manifests)
+        if not counts or shards != set(range(counts.pop())):
+            raise ValueError('missing shard manifests in {0}'.format(dest))
+
+        files = {}
+        for _, _, path in manifests:
+            with open(path) as f:
+                manifest = yaml.safe_load(f) or {}
+
+            for filename, metadata in manifest.items():
+                files[filename] = frontmatter.Post('', **metadata)
+
+        # collection-level plugins work just like middleware
+        for func in plugins or []:
+            func(files, self)
+
+        return files
+
     def serialize(self, as_dict=False, sort=None):
         """
         Dump built files as a list or dictionary, for JSON or other serialization.
@@ -166,3 +426,23 @@ class Stack(object):
         self.middleware.append(func)
         return func
 
+    def filter(self, func):
+        """
+        Add a load-time filter. Like `use`, this returns func,
+        so it can be used as a decorator.
+
+        func should take two arguments, filename and metadata,
+        and return False for any file that should be skipped.
+        Rejected files are never fully loaded or passed to middleware.
+
+        @stack.filter
+        def published(filename, metadata):
+            return metadata.get('published', True)
+
+        """
+        if not callable(func):
+            raise TypeError('Stack.filter requires a callable')
+
+        self.filters.append(func)
+        return func
+
@@ -1,9 +1,20 @@
 """
 This is a simple drafts plugin that filters out any files marked 'draft' in Frontmatter metadata.
+
+Because it only looks at metadata, Stack applies it as a load-time filter,
+so drafts are skipped before their content is loaded or any middleware runs.
 """
 
+def not_draft(filename, metadata):
+    "Return False for any file marked 'draft'"
+    return not metadata.get('draft')
+
+
 def drafts(files, stack):
     "Filter out any files marked 'draft'"
     for path, post in list(files.items()):
         if post.get('draft'):
             del files[path]
+
+# let Stack skip drafts as they load
+drafts.predicate = not_draft
@@ -3,12 +3,50 @@ Render posts with templates
 """
 import os
 
+import frontmatter
+
 from . import Plugin
 
+
+def files_key(files, stack):
+    "Default cache key for shared values: metadata and content for every file"
+    return repr(sorted(
+        (filename, sorted(post.metadata.items()), post.content)
+        for filename, post in files.items()
+    ))
+
+
+def snapshot(files):
+    "Copy posts, so shared values don't change when posts are rendered"
+    copies = {}
+    for filename, post in files.items():
+        copy = frontmatter.Post(post.content)
+        copy.metadata = dict(post.metadata)
+        copies[filename] = copy
+
+    return copies
+
+
+def source_key(stack):
+    "Modification times and sizes of a stack's source files"
+    key = []
+    for filename in sorted(os.listdir(stack.source)):
+        if stack.in_shard(filename):
+            stat = os.stat(os.path.join(stack.source, filename))
+            key.append((filename, stat.st_mtime, stat.st_size))
+
+    return key
+
+
 class Jinja(Plugin):
     """
     Render templates with post as context.
     Use an existing jinja2 environment or simply pass a template directory.
+
+    Site-wide values, like nav menus or recent posts, can be registered
+    with `share` or `fragment`. These are computed once per run, not once
+    per post, from copies of every file in the stack taken before rendering,
+    and only recomputed when their inputs change.
     """
     def __init__(self, template_dir='templates', default_template=None, loader=None, environment=None):
         # do imports here so other template engines can work independently
@@ -30,11 +68,109 @@ class Jinja(Plugin):
         if default_template:
             self.default_template = self.env.get_template(default_template)
 
+        # name => (func, depends), and name => (key, value)
+        self.shared = {}
+        self.cache = {}
+        self.fragments = set()
+
+        # (source key, files) for the whole site, loaded when Stack.get hands us a single file
+        self.site = None
+
+    def share(self, name, depends=None):
+        """
+        Register a function to compute a shared context value,
+        available to every template as `name`. Use as a decorator:
+
+        @jinja.share('recent')
+        def recent(files, stack):
+            return sorted(files.values(), key=lambda p: p['date'])[-5:]
+
+        The value is recomputed only when `depends(files, stack)` returns
+        a different key. By default, that's the metadata and content of every file.
+        """
+        def decorator(func):
+            self.shared[name] = (func, depends or files_key)
+            self.cache.pop(name, None)
+            return func
+
+        return decorator
+
+    def fragment(self, name, template, depends=None):
+        """
+        Register a template to render once per run, with `files` and `stack`
+        as context. The result is available to every template as `name`.
+        Editing the template's source also invalidates it.
+
+        Fragments render after values from `share`, so they can use those,
+        but they can't depend on other fragments.
+        """
+        from markupsafe import Markup
+
+        depends = depends or files_key
+
+        def render(files, stack):
+            return Markup(self.env.get_template(template).render(files=files, stack=stack))
+
+        def key(files, stack):
+            source = self.env.loader.get_source(self.env, template)[0]
+            return (depends(files, stack), source)
+
+        self.share(name, key)(render)
+        self.fragments.add(name)
+
+    def load_site(self, stack):
+        "Load every file in the stack, processed up to this plugin"
+        files = stack.get_files()
+        if self in stack.middleware:
+            for func in stack.middleware[:stack.middleware.index(self)]:
+                func(files, stack)
+
+        return files
+
+    def render_shared(self, files, stack):
+        """
+        Compute shared values, reusing cached ones whose inputs haven't changed.
+
+        Stack.run passes the whole site, but Stack.get passes a single file.
+        In that case, load the site once, and load it again only when
+        a source file changes.
+        """
+        if stack.partial:
+            key = source_key(stack)
+            if self.site is not None and self.site[0] == key:
+                # values for this site are already set
+                return
+
+            self.site = (key, self.load_site(stack))
+            files = self.site[1]
+
+        else:
+            self.site = None
+
+        files = snapshot(files)
+
+        # plain values first, so fragments can use them
+        names = sorted(self.shared, key=lambda name: name in self.fragments)
+        for name in names:
+            func, depends = self.shared[name]
+            key = depends(files, stack)
+
+            if name in self.cache and self.cache[name][0] == key:
+                value = self.cache[name][1]
+            else:
+                value = func(files, stack)
+                self.cache[name] = (key, value)
+
+            self.env.globals[name] = value
+
     def run(self, files, stack):
         "Render templates"
         # make stack available to all templates
         self.env.globals['stack'] = stack
 
+        # compute site-wide values once, before any post renders
+        self.render_shared(files, stack)
+
         for filename, post in files.items():
             # render content first
             post.content = self.env.from_string(post.content).render(post.metadata)
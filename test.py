@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import codecs
 import datetime
+import io
+import multiprocessing
 import os
 import shutil
 import unittest
@@ -11,6 +13,14 @@ from jinja2 import Environment, FileSystemLoader
 from markdown import markdown
 
 from metalsmyth import Stack, PostNotFound
+from metalsmyth.plugins.markup import Markdown
+
+
+def build_shard(index, count):
+    "Build one shard of tests/markup, for running in a separate process"
+    stack = Stack('tests/markup', Markdown(), shard=(index, count))
+    stack.build('tests/tmp')
+
 
 class StackTest(unittest.TestCase):
     "Base class for tests."
@@ -97,6 +107,79 @@ class DraftTest(StackTest):
         with self.assertRaises(PostNotFound):
             self.stack.get('network-diagrams.markdown')
 
+    def test_drafts_skipped_at_load(self):
+        "Drafts never reach earlier middleware"
+        seen = []
+
+        def record(files, stack):
+            seen.extend(files.keys())
+
+        self.stack.middleware.insert(0, record)
+        self.stack.run()
+
+        self.assertEqual(seen, ['hello.markdown'])
+
+
+class FilterTest(StackTest):
+    """
+    Tests for load-time filters
+    """
+    def setUp(self):
+        self.stack = Stack('tests/markup')
+
+    def test_filter(self):
+        "Filters see metadata, and rejected files are skipped"
+        @self.stack.filter
+        def no_templates(filename, metadata):
+            self.assertEqual(metadata['filename'], filename)
+            return 'template' not in metadata
+
+        files = self.stack.run()
+        raw = Stack('tests/markup').get_files()
+
+        self.assertTrue(no_templates in self.stack.filters)
+        self.assertEqual(
+            set(files),
+            set(fn for fn, p in raw.items() if 'template' not in p.metadata)
+        )
+
+    def test_filtered_posts_match(self):
+        "Posts that pass filters load the same as without filters"
+        stack = Stack('tests/markup', filters=[lambda fn, m: True])
+        raw = Stack('tests/markup').get_files()
+
+        for filename, post in stack.get_files().items():
+            self.assertEqual(post.to_dict(), raw[filename].to_dict())
+
+    def test_non_dict_frontmatter(self):
+        "Frontmatter that isn't a mapping falls back to a full load"
+        from metalsmyth.plugins.drafts import drafts
+        stack = Stack('tests/lists', drafts)
+        files = stack.run()
+
+        self.assertEqual(set(files), set(['list.md', 'dashes.md']))
+        self.assertEqual(
+            files['list.md'].content,
+            frontmatter.load('tests/lists/list.md').content
+        )
+
+    def test_long_delimiters(self):
+        "Headers with longer dashed delimiters are read without a full load"
+        stack = Stack('tests/lists', filters=[lambda fn, m: fn != 'list.md'])
+
+        with io.open('tests/lists/dashes.md', encoding='utf-8') as f:
+            metadata, lines = stack.read_header(f)
+
+        self.assertEqual(metadata, {'title': 'Dashes'})
+        self.assertEqual(list(stack.get_files()), ['dashes.md'])
+
+    def test_filter_get(self):
+        "A filtered file isn't found"
+        stack = Stack('tests/markup', filters=[lambda fn, m: fn != 'ebola.md'])
+
+        with self.assertRaises(PostNotFound):
+            stack.get('ebola.md')
+
 
 class DateTest(StackTest):
     """
@@ -208,6 +291,132 @@ class TemplateTest(StackTest):
         self.assertEqual(test.content, post.content)
 
 
+class SharedTemplateTest(StackTest):
+    """
+    Tests for shared values in the template plugin
+    """
+
+    def setUp(self):
+        from metalsmyth.plugins.template import Jinja
+
+        self.jinja = Jinja('tests/templates', default_template='shared.html')
+        self.env = Environment(loader=FileSystemLoader('tests/templates'))
+        self.stack = Stack('tests/markup', self.jinja)
+        self.calls = []
+
+        @self.jinja.share('count')
+        def count(files, stack):
+            self.calls.append(len(files))
+            return len(files)
+
+        self.jinja.fragment('recent', 'recent.html')
+
+    def test_shared_values(self):
+        "Shared values are computed once and rendered into every post"
+        raw = self.stack.get_files()
+        files = self.stack.run()
+        recent = self.env.get_template('recent.html').render(files=raw)
+
+        self.assertEqual(self.calls, [len(raw)])
+        self.assertEqual(self.jinja.env.globals['recent'], recent)
+
+        # only posts without their own template use shared.html
+        for post in files.values():
+            if 'template' in post.metadata:
+                continue
+
+            self.assertTrue(recent in post.content)
+            self.assertTrue('{0} posts'.format(len(raw)) in post.content)
+
+    def test_shared_cache(self):
+        "Shared values are only recomputed when inputs change"
+        self.stack.run()
+        self.stack.run()
+        self.assertEqual(len(self.calls), 1)
+
+        self.stack.filters.append(lambda fn, m: fn != 'ebola.md')
+        self.stack.run()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.jinja.env.globals['count'], self.calls[-1])
+
+    def test_shared_posts_not_rendered(self):
+        "Shared posts keep their bodies, not rendered pages, across runs"
+        self.jinja.share('posts')(lambda files, stack: sorted(
+            files.values(), key=lambda p: p['filename']))
+
+        raw = self.stack.get_files()
+        self.stack.run()
+        self.stack.run()
+
+        posts = self.jinja.env.globals['posts']
+        self.assertEqual(len(posts), len(raw))
+        for p in posts:
+            self.assertEqual(p.content, raw[p['filename']].content)
+
+    def test_fragment_uses_shared_value(self):
+        "Fragments render after shared values, on the first run"
+        from jinja2 import DictLoader
+        from metalsmyth.plugins.template import Jinja
+
+        jinja = Jinja(loader=DictLoader({'total.html': 'Total: {{ count }}'}))
+        jinja.fragment('total', 'total.html')
+        jinja.share('count')(lambda files, stack: len(files))
+        self.stack = Stack('tests/noop', jinja)
+        self.stack.run()
+
+        self.assertEqual(jinja.env.globals['total'], 'Total: 2')
+
+    def test_shared_with_iter(self):
+        "Stack.iter and Stack.get still see the whole site, computed once"
+        raw = self.stack.get_files()
+        posts = list(self.stack.iter())
+
+        self.assertEqual(len(posts), len(raw))
+        self.assertEqual(self.calls, [len(raw)])
+
+        post = self.stack.get('template.md', reset=True)
+        self.assertTrue('{0} posts'.format(len(raw)) in post.content)
+        self.assertEqual(self.calls, [len(raw)])
+
+    def test_shared_content_change(self):
+        "Changing a post's body or a fragment's template invalidates shared values"
+        from metalsmyth.plugins.template import Jinja
+
+        source = os.path.join('tests/tmp', 'src')
+        templates = os.path.join('tests/tmp', 'templates')
+        shutil.copytree('tests/noop', source)
+        shutil.copytree('tests/templates', templates)
+
+        jinja = Jinja(templates)
+        jinja.share('hello')(lambda files, stack: files['hello.markdown'].content)
+        jinja.fragment('recent', 'recent.html')
+        self.stack = Stack(source, jinja, dest='tests/tmp')
+
+        self.stack.run()
+        self.assertEqual(jinja.env.globals['hello'], 'Well, hello there, world.')
+
+        post = frontmatter.load(os.path.join(source, 'hello.markdown'))
+        post.content = 'Goodbye, world.'
+        with codecs.open(os.path.join(source, 'hello.markdown'), 'w', 'utf-8') as f:
+            f.write(frontmatter.dumps(post))
+
+        with open(os.path.join(templates, 'recent.html'), 'w') as f:
+            f.write('{{ files|length }}')
+
+        self.stack.run()
+        self.assertEqual(jinja.env.globals['hello'], 'Goodbye, world.')
+        self.assertEqual(jinja.env.globals['recent'], '2')
+
+        # one post at a time, the site reloads when a source file changes
+        self.stack.get('hello.markdown', reset=True)
+        post.content = 'So long, world, and thanks for all the posts.'
+        with codecs.open(os.path.join(source, 'hello.markdown'), 'w', 'utf-8') as f:
+            f.write(frontmatter.dumps(post))
+
+        self.stack.get('hello.markdown', reset=True)
+        self.assertEqual(jinja.env.globals['hello'], post.content)
+
+
 class SerializationTest(StackTest):
     """
     Tests of serialization
@@ -303,5 +512,137 @@ class IterTest(StackTest):
             self.assertEqual(test.to_dict(), post.to_dict())
 
 
+class ShardTest(StackTest):
+    """
+    Tests for sharded builds
+    """
+    def setUp(self):
+        self.stack = Stack('tests/markup', dest='tests/tmp')
+
+    def test_shards_partition_files(self):
+        "Every file lands in exactly one shard"
+        filenames = set(os.listdir(self.stack.source))
+        seen = []
+        for i in range(3):
+            stack = Stack('tests/markup', shard=(i, 3))
+            seen.extend(stack.get_files().keys())
+
+        self.assertEqual(len(seen), len(filenames))
+        self.assertEqual(set(seen), filenames)
+
+    def test_bad_shard(self):
+        with self.assertRaises(ValueError):
+            Stack('tests/markup', shard=(3, 3))
+
+    def test_sharded_build_and_merge(self):
+        "Build shards in separate processes, then merge manifests"
+        workers = [multiprocessing.Process(target=build_shard, args=(i, 3)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+        filenames = set(os.listdir(self.stack.source))
+        built = set(fn for fn in os.listdir(self.stack.dest) if not fn.startswith('.'))
+        self.assertEqual(built, filenames)
+
+        def count_files(files, stack):
+            stack.metadata['count'] = len(files)
+
+        files = self.stack.merge([count_files])
+
+        self.assertEqual(set(files), filenames)
+        self.assertEqual(self.stack.metadata['count'], len(filenames))
+        for filename, post in files.items():
+            raw = frontmatter.load(os.path.join(self.stack.source, filename))
+            self.assertEqual(post['title'], raw['title'])
+            self.assertEqual(post['filename'], filename)
+
+    def test_merge_missing_shard(self):
+        "Merging without every shard's manifest is an error"
+        build_shard(0, 3)
+
+        with self.assertRaises(ValueError):
+            self.stack.merge()
+
+    def test_rebuild_with_new_shard_count(self):
+        "Rebuilding with a different shard count clears old manifests"
+        build_shard(0, 2)
+        build_shard(1, 2)
+        build_shard(0, 1)
+
+        files = self.stack.merge()
+        self.assertEqual(set(files), set(os.listdir(self.stack.source)))
+        self.assertFalse(any(fn.endswith('.tmp') for fn in os.listdir(self.stack.dest)))
+
+    def test_get_outside_shard(self):
+        "Stack.get won't load files from another shard"
+        shards = [Stack('tests/markup', shard=(i, 2)) for i in range(2)]
+        filename = sorted(shards[1].get_files())[0]
+
+        with self.assertRaises(PostNotFound):
+            shards[0].get(filename)
+
+        self.assertEqual(shards[1].get(filename)['filename'], filename)
+
+    def test_manifest_types(self):
+        "String subclasses are written as strings, other objects are a clear error"
+        from markupsafe import Markup
+        stack = Stack('tests/markup', shard=(0, 1), dest='tests/tmp')
+
+        @stack.use
+        def summarize(files, stack):
+            for post in files.values():
+                post['summary'] = Markup('<p>Summary</p>')
+
+        stack.build()
+        files = self.stack.merge()
+
+        for post in files.values():
+            self.assertEqual(post['summary'], '<p>Summary</p>')
+
+        # manifests need to be readable by whoever runs the merge
+        path = os.path.join('tests/tmp', '.metalsmyth-0-of-1.yaml')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+        stack = Stack('tests/markup', shard=(0, 1), dest='tests/tmp')
+
+        @stack.use
+        def broken(files, stack):
+            for post in files.values():
+                post['broken'] = object()
+
+        with self.assertRaises(ValueError):
+            stack.build()
+
+        self.assertFalse(any(fn.endswith('.tmp') for fn in os.listdir('tests/tmp')))
+
+    def test_unsharded_build_keeps_manifests(self):
+        "Only sharded builds, or clean=True, remove manifests"
+        build_shard(0, 1)
+
+        Stack('tests/noop').build('tests/tmp')
+        self.assertEqual(len(self.stack.find_manifests()), 1)
+
+        Stack('tests/noop').build('tests/tmp', clean=True)
+        self.assertEqual(self.stack.find_manifests(), [])
+
+    def test_merge_count(self):
+        "Merge can be limited to one shard count"
+        build_shard(0, 2)
+        build_shard(1, 2)
+
+        # a stray manifest from some other build
+        with open(os.path.join(self.stack.dest, '.metalsmyth-0-of-1.yaml'), 'w') as f:
+            f.write('missing.md: {title: Missing}\n')
+
+        with self.assertRaises(ValueError):
+            self.stack.merge()
+
+        files = self.stack.merge(count=2)
+        self.assertEqual(set(files), set(os.listdir(self.stack.source)))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file